@@ -1,61 +1,278 @@
-from main import get_latest_email_body_text
+from main import get_latest_email_body_text, get_latest_emails
+import asyncio
+import atexit
+from collections import OrderedDict
+import hashlib
 import json
 import re
+import shelve
+import threading
 import requests
-from ollama import Client
+from ollama import AsyncClient
 from zoneinfo import ZoneInfo
 from datetime import datetime, timedelta
 
+try:
+    import orjson  # optional, faster JSON parse/serialize
+except ImportError:
+    orjson = None
+
+_loads = orjson.loads if orjson is not None else json.loads
+_dumps = orjson.dumps if orjson is not None else json.dumps  # bytes with orjson, str with json
+
+# Start the server with OLLAMA_NUM_PARALLEL=N (e.g. `OLLAMA_NUM_PARALLEL=4 ollama serve`)
+# so concurrent requests from classify_many are actually decoded in parallel.
 MODEL = "llama3.2"
 ALLOWED = {"INTENT_SCHEDULE_MEETING", "REQUEST_SCHEDULED_MEETING", "OTHER"}
 
 LOCAL_TZ = datetime.now().astimezone().tzinfo
 
+# Bump PROMPT_VERSION whenever _SYSTEM_PROMPT / _RESULT_SCHEMA change so old
+# cached answers are not reused.
+PROMPT_VERSION = "2"
+CACHE_FILE = ".llm_cache"
+MEMO_SIZE = 1024  # max results kept in the in-process memo
+_MEMO: OrderedDict[str, str | bytes] = OrderedDict()
+_SHELF = None
+_SHELF_LOCK = threading.Lock()  # dbm isn't safe to use from several threads at once
+
+# One client for the whole process so its connection pool to the Ollama
+# server is reused instead of rebuilt on every call.
+_ACLIENT = AsyncClient()
+
 def _extract_json(text: str) -> dict:
     """
-    Ollama models sometimes add extra text.
-    This pulls out the first JSON object if needed.
-    """
-    text = text.strip()
-    if text.startswith("{") and text.endswith("}"):
-        return json.loads(text)
-
-    m = re.search(r"\{.*\}", text, re.DOTALL)
-    if not m:
-        raise ValueError("Model did not return JSON.")
-    return json.loads(m.group(0))
-
-def classify_with_ollama(email_body: str) -> dict:
-    SYSTEM_PROMPT = """You are an email intent classifier.
-    Choose exactly ONE label:
-    - INTENT_SCHEDULE_MEETING: the sender gives an exact time for a meeting, It is set into place already the meeting. There is clear indication of date and time of the meeting for it to be scheduled. 
-    - REQUEST_SCHEDULED_MEETING: the sender asks you to schedule/confirm/reschedule an already-discussed meeting, or logistical coordination (calendar invite, Zoom link, time change).
-    - OTHER: everything else.
-
-    Output ONLY valid JSON in this exact schema:
-    {
-    "label": "INTENT_SCHEDULE_MEETING" | "REQUEST_SCHEDULED_MEETING" | "OTHER",
-    "confidence": number between 0 and 1,
-    "rationale": "1-2 short sentences"
-    }
-    No extra keys. No markdown. No surrounding text.
-    """
-    client = Client()
-    payload = client.chat(
-        model=MODEL,
-        messages= [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": email_body[:8000]}, #can change so that it takes more than 8000 of the first characters
-        ],
-        options= {
-            "temperature": 0
-        }
+    Replies are constrained to a JSON schema (format=...), so they parse
+    directly. A reply cut off by num_predict is still reported as ValueError.
+    """
+    try:
+        data = _loads(text)
+    except json.JSONDecodeError as e:  # orjson.JSONDecodeError subclasses it
+        raise ValueError("Model did not return JSON.") from e
+    if not isinstance(data, dict):
+        raise ValueError("Model did not return a JSON object.")
+    return data
+
+# num_predict caps decoding (one result is ~120 tokens) so a runaway
+# generation can't stall a call. num_ctx fits the system prompt plus a
+# 12000-char body; every call (incl. warm_model) uses the same value because
+# Ollama reloads the model when num_ctx changes.
+_NUM_PREDICT = 200
+_NUM_CTX = 8192
+_OPTS = {"temperature": 0, "num_predict": _NUM_PREDICT, "num_ctx": _NUM_CTX}
+
+# Cheap check run before the LLM: emails with none of these words in their
+# first 2000 chars (newsletters, receipts, notifications) are labelled OTHER
+# without an Ollama call. A miss silently drops a meeting, so this errs on
+# the side of false positives: verbs match as prefixes ("scheduled",
+# "invitation", "calls"), and any weekday, month, relative date, time or
+# day-of-month ("the 12th") is enough to send the email to the model.
+_PREFILTER = re.compile(
+    r"\b(meet|call|schedul|reschedul|invit|calendar|zoom|teams|sync|chat|talk|catch\w* up|availab"
+    r"|appointment|agenda|session|interview|demo)\w*"
+    r"|\b(mon|tue|wed|thu|fri|sat|sun)\w*"
+    r"|\b(jan(uary)?|feb(ruary)?|mar(ch)?|apr(il)?|may|june?|july?|aug(ust)?|sep(t(ember)?)?"
+    r"|oct(ober)?|nov(ember)?|dec(ember)?)\b"
+    r"|\b(today|tomorrow|tonight|next (week|month)|this (week|month)|noon|midnight)\b"
+    r"|\b\d{1,2}([:.]\d{2})?\s*(am|pm|a\.m\.|p\.m\.)"
+    r"|\b\d{1,2}[:.]\d{2}\b|\b\d{1,2}/\d{1,2}\b|\b\d{1,2}(st|nd|rd|th)\b",
+    re.I,
+)
+
+# System prompts are fully static so Ollama can reuse the cached prefill of
+# this prefix across calls; anything that changes per call (the reference
+# datetime) goes in the user message instead.
+_RULES = """You are an email intent classifier and meeting time extractor.
+Choose exactly ONE label:
+- INTENT_SCHEDULE_MEETING: the sender gives an exact time for a meeting, It is set into place already the meeting. There is clear indication of date and time of the meeting for it to be scheduled. 
+- REQUEST_SCHEDULED_MEETING: the sender asks you to schedule/confirm/reschedule an already-discussed meeting, or logistical coordination (calendar invite, Zoom link, time change).
+- OTHER: everything else.
+
+The user message starts with the reference datetime and timezone offset, then the email.
+
+If label != INTENT_SCHEDULE_MEETING, leave the datetime fields empty
+(start_iso="", end_iso="", timezone="", needs_clarification=false, clarification_question="").
+Otherwise extract the meeting start/end datetime:
+- Resolve relative dates like "tomorrow", "next Monday" using the reference datetime.
+- If the email provides an exact meeting time, output start_iso and end_iso as RFC3339/ISO8601 with offset.
+- If duration is not stated, assume 30 minutes.
+- If the email only provides a window (e.g. "2-4pm") or is missing a date or time, do NOT guess.
+  Set start_iso="" and end_iso="" and needs_clarification=true, with a short clarification_question.
+
+"""
+
+_RESULT_SCHEMA = """{
+"label": "INTENT_SCHEDULE_MEETING" | "REQUEST_SCHEDULED_MEETING" | "OTHER",
+"confidence": number between 0 and 1,
+"rationale": "1-2 short sentences",
+"start_iso": string,
+"end_iso": string,
+"timezone": string,
+"needs_clarification": boolean,
+"clarification_question": string
+}
+No extra keys. No markdown. No surrounding text.
+"""
+
+_SYSTEM_PROMPT = (
+    _RULES
+    + "Output ONLY valid JSON in this exact schema:\n"
+    + _RESULT_SCHEMA
+)
+
+# Wrapped in {"results": [...]} so the reply is still a single JSON object.
+_BATCH_SYSTEM_PROMPT = (
+    _RULES
+    + "You will get several emails, each between <<EMAIL n>> and <<END EMAIL n>>.\n"
+    + "Classify each one independently.\n"
+    + 'Output ONLY valid JSON: {"results": [ ... ]} with exactly one entry per email,\n'
+    + 'each entry having "index": n plus this exact schema:\n'
+    + _RESULT_SCHEMA
+)
+
+# JSON schemas passed as format=..., so Ollama constrains decoding to valid
+# output instead of relying on the prompt alone.
+_RESULT_PROPERTIES = {
+    "label": {"type": "string", "enum": sorted(ALLOWED)},
+    "confidence": {"type": "number"},
+    "rationale": {"type": "string"},
+    "start_iso": {"type": "string"},
+    "end_iso": {"type": "string"},
+    "timezone": {"type": "string"},
+    "needs_clarification": {"type": "boolean"},
+    "clarification_question": {"type": "string"},
+}
+
+_RESULT_FORMAT = {
+    "type": "object",
+    "properties": _RESULT_PROPERTIES,
+    "required": list(_RESULT_PROPERTIES),
+}
+
+_BATCH_FORMAT = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"index": {"type": "integer"}, **_RESULT_PROPERTIES},
+                "required": ["index", *_RESULT_PROPERTIES],
+            },
+        },
+    },
+    "required": ["results"],
+}
+
+# How many emails fit in one batched request. Each one costs its body (cut to
+# _BATCH_BODY_CHARS) plus its delimiters and _NUM_PREDICT output tokens; the
+# batch system prompt and reference header come out of num_ctx first.
+# Estimated at 3 chars/token to leave headroom for non-English text, which
+# gives 4 emails per request at num_ctx=8192.
+_BATCH_BODY_CHARS = 4000
+_CHARS_PER_TOKEN = 3
+_BATCH_SIZE = max(
+    1,
+    (_NUM_CTX - len(_BATCH_SYSTEM_PROMPT) // _CHARS_PER_TOKEN - 100)
+    // (_BATCH_BODY_CHARS // _CHARS_PER_TOKEN + 20 + _NUM_PREDICT),
+)
+
+def _reference_header(now: datetime) -> str:
+    reference = now.isoformat()            # includes offset, e.g. 2026-01-12T18:03:00-08:00
+    tz_offset = now.strftime("%z")         # e.g. -0800
+    return (
+        f"Reference datetime (user local time): {reference}\n"
+        f"User timezone offset: {tz_offset}\n\n"
+    )
+
+def _fill_defaults(data: dict, now: datetime) -> dict:
+    # Ensure required keys exist + keep timezone as a string
+    data.setdefault("start_iso", "")
+    data.setdefault("end_iso", "")
+    data.setdefault("needs_clarification", False)
+    data.setdefault("clarification_question", "")
+    if data.get("label") == "INTENT_SCHEDULE_MEETING":
+        data.setdefault("timezone", now.strftime("%z"))
+    else:
+        data.setdefault("timezone", "")
+    return data
+
+def _skip_llm(email_body: str) -> bool:
+    return _PREFILTER.search(email_body[:2000]) is None
+
+def _prefiltered_other(now: datetime) -> dict:
+    return _fill_defaults(
+        {
+            "label": "OTHER",
+            "confidence": 0.99,
+            "rationale": "No meeting-related keywords found; skipped the model.",
+        },
+        now,
     )
-    return payload["message"]["content"]
 
-def extract_datetime_with_ollama(email_text: str, now: datetime | None = None) -> dict:
+def _cache_key(email_body: str, now: datetime) -> str:
+    """
+    Same email, model, prompt and day -> same answer. The date and offset are
+    part of the key because "tomorrow" resolves differently on another day.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for part in (MODEL, PROMPT_VERSION, now.date().isoformat(), now.strftime("%z"), email_body[:12000]):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+def _shelf() -> shelve.Shelf:
+    # Opened once on first use and closed at exit, instead of per lookup.
+    global _SHELF
+    if _SHELF is None:
+        _SHELF = shelve.open(CACHE_FILE)
+        atexit.register(_SHELF.close)
+    return _SHELF
+
+def _disk_get(key: str) -> str | bytes | None:
+    with _SHELF_LOCK:
+        return _shelf().get(key)
+
+def _disk_put(key: str, raw: str | bytes) -> None:
+    with _SHELF_LOCK:
+        db = _shelf()
+        db[key] = raw
+        db.sync()
+
+def _memo_put(key: str, raw: str | bytes) -> None:
+    _MEMO[key] = raw
+    _MEMO.move_to_end(key)
+    if len(_MEMO) > MEMO_SIZE:
+        _MEMO.popitem(last=False)  # drop the least recently used entry
+
+async def _cache_get(key: str) -> dict | None:
     """
-    Returns ONLY fields needed to schedule a Google Calendar event:
+    Checks the in-process LRU memo first, then the on-disk shelve at
+    CACHE_FILE (in a worker thread, so the event loop isn't blocked).
+    Stored as JSON text so every caller gets its own fresh dict.
+    """
+    raw = _MEMO.get(key)
+    if raw is not None:
+        _MEMO.move_to_end(key)
+    else:
+        raw = await asyncio.to_thread(_disk_get, key)
+        if raw is None:
+            return None
+        _memo_put(key, raw)
+    return _loads(raw)
+
+async def _cache_put(key: str, data: dict) -> None:
+    raw = _dumps(data)
+    _memo_put(key, raw)
+    await asyncio.to_thread(_disk_put, key, raw)
+
+async def classify_with_ollama(email_body: str, now: datetime | None = None) -> dict:
+    """
+    Classifies the email and, for INTENT_SCHEDULE_MEETING, extracts the
+    meeting start/end in the same call so the body is only sent once.
+
+    Returns a dict with:
+      - label, confidence, rationale
       - start_iso (RFC3339/ISO8601 with offset) or ""
       - end_iso   (RFC3339/ISO8601 with offset) or ""
       - timezone  (IANA name if possible, otherwise offset like -0800)
@@ -65,68 +282,132 @@ def extract_datetime_with_ollama(email_text: str, now: datetime | None = None) -
     if now is None:
         now = datetime.now().astimezone()  # local timezone-aware
 
-    reference = now.isoformat()            # includes offset, e.g. 2026-01-12T18:03:00-08:00
-    tz_offset = now.strftime("%z")         # e.g. -0800
+    if _skip_llm(email_body):
+        return _prefiltered_other(now)
 
-    system_prompt = f"""You extract meeting start/end datetime from an email.
+    key = _cache_key(email_body, now)
+    cached = await _cache_get(key)
+    if cached is not None:
+        return cached
 
-Reference datetime (user local time): {reference}
-User timezone offset: {tz_offset}
-
-Rules:
-- Resolve relative dates like "tomorrow", "next Monday" using the reference datetime.
-- If the email provides an exact meeting time, output start_iso and end_iso as RFC3339/ISO8601 with offset.
-- If duration is not stated, assume 30 minutes.
-- If the email only provides a window (e.g. "2-4pm") or is missing a date or time, do NOT guess.
-  Set start_iso="" and end_iso="" and needs_clarification=true, with a short clarification_question.
+    payload = await _ACLIENT.chat(
+        model=MODEL,
+        messages= [
+            {"role": "system", "content": _SYSTEM_PROMPT},
+            {"role": "user", "content": _reference_header(now) + "Email:\n" + email_body[:12000]}, #can change so that it takes more than 12000 of the first characters
+        ],
+        format=_RESULT_FORMAT,
+        options=_OPTS,
+    )
 
-Output ONLY valid JSON with EXACTLY these keys:
-{{
-  "start_iso": string,
-  "end_iso": string,
-  "timezone": string,
-  "needs_clarification": boolean,
-  "clarification_question": string
-}}
-No extra text.
-"""
+    data = _fill_defaults(_extract_json(payload["message"]["content"]), now)
+    await _cache_put(key, data)
+    return data
 
-    client = Client()
-    resp = client.chat(
+async def _classify_group(bodies: list[str], now: datetime) -> list[dict]:
+    """
+    One batched chat request for at most _BATCH_SIZE bodies.
+    Emails the reply leaves out (or all of them, if the reply doesn't parse)
+    are classified one by one with classify_with_ollama, so one bad reply
+    doesn't lose the results of the rest of the batch.
+    Returns one dict per body, in order.
+    """
+    user_msg = "\n\n".join(
+        f"<<EMAIL {n}>>\n{body[:_BATCH_BODY_CHARS]}\n<<END EMAIL {n}>>"
+        for n, body in enumerate(bodies, start=1)
+    )
+    payload = await _ACLIENT.chat(
         model=MODEL,
         messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": email_text[:12000]},
+            {"role": "system", "content": _BATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": _reference_header(now) + f"Classify each of the following {len(bodies)} emails.\n\n{user_msg}"},
         ],
-        options={"temperature": 0},
+        format=_BATCH_FORMAT,
+        options={**_OPTS, "num_predict": _NUM_PREDICT * len(bodies)},
     )
 
-    data = _extract_json(resp["message"]["content"])
+    try:
+        data = _extract_json(payload["message"]["content"])
+    except ValueError:
+        data = {}  # e.g. cut off by num_predict; every email falls back below
+    by_index = {}
+    for item in data.get("results", []):
+        if isinstance(item, dict) and isinstance(item.get("index"), int):
+            by_index[item.pop("index")] = _fill_defaults(item, now)
 
-    # Ensure required keys exist + keep timezone as a string
-    data.setdefault("timezone", tz_offset)
-    data.setdefault("start_iso", "")
-    data.setdefault("end_iso", "")
-    data.setdefault("needs_clarification", False)
-    data.setdefault("clarification_question", "")
+    missing = [n for n in range(1, len(bodies) + 1) if n not in by_index]
+    retried = await asyncio.gather(*(classify_with_ollama(bodies[n - 1], now) for n in missing))
+    by_index.update(zip(missing, retried))
+    return [by_index[n] for n in range(1, len(bodies) + 1)]
+
+async def classify_batch(bodies: list[str], now: datetime | None = None) -> list[dict]:
+    """
+    Classifies several emails with one chat request per group of _BATCH_SIZE,
+    so the system prompt is prefilled once per group instead of once per email.
+    Each body is truncated to _BATCH_BODY_CHARS and groups are sized so the
+    prompt plus the expected output fit in num_ctx.
+    Bodies rejected by the keyword prefilter are labelled OTHER and left out.
+
+    Returns one dict per body (same keys as classify_with_ollama), in order.
+    """
+    if not bodies:
+        return []
+    if now is None:
+        now = datetime.now().astimezone()  # local timezone-aware
+
+    results = [_prefiltered_other(now) if _skip_llm(b) else None for b in bodies]
+    pending = [i for i, r in enumerate(results) if r is None]
+    groups = [pending[k:k + _BATCH_SIZE] for k in range(0, len(pending), _BATCH_SIZE)]
+
+    group_results = await asyncio.gather(
+        *(_classify_group([bodies[i] for i in group], now) for group in groups)
+    )
+    for group, group_result in zip(groups, group_results):
+        for i, result in zip(group, group_result):
+            results[i] = result
+    return results
+
+async def classify_latest(count: int, now: datetime | None = None) -> list[dict]:
+    """
+    Fetches the `count` newest Inbox emails (batched Gmail calls, run in a
+    thread) and classifies them via classify_batch, which splits them into
+    model requests of at most _BATCH_SIZE emails each.
+    """
+    emails = await asyncio.to_thread(get_latest_emails, count)
+    return await classify_batch([e["body"]["content"] for e in emails], now)
+
+async def classify_many(bodies: list[str], now: datetime | None = None) -> list[dict]:
+    """
+    Classifies several emails concurrently; results keep the order of bodies.
+    """
+    return await asyncio.gather(*(classify_with_ollama(b, now) for b in bodies))
 
-    return data
+
+async def warm_model():
+    """
+    An empty chat just loads MODEL into memory, so the first real
+    classification doesn't pay the model load time.
+    """
+    await _ACLIENT.chat(model=MODEL, messages=[], options=_OPTS)
 
 
-def recieved_Intent(email_text: str):
-    data2 = extract_datetime_with_ollama(email_text)
+def recieved_Intent(data: dict):
     print("Extracted datetime info:")
-    print(data2["start_iso"])
+    print(data["start_iso"])
 
-if __name__ == "__main__":
-    body = get_latest_email_body_text()
-    result = classify_with_ollama(body["body"]["content"])
-    result2 = _extract_json(result)
+async def main():
+    # Gmail fetch is blocking I/O; run it in a thread while the model loads.
+    body, _ = await asyncio.gather(
+        asyncio.to_thread(get_latest_email_body_text),
+        warm_model(),
+    )
+    [result] = await classify_many([body["body"]["content"]])
     print(LOCAL_TZ)
     print(result)
-    print(result2["label"])
+    print(result["label"])
 
-    if result2["label"] == "INTENT_SCHEDULE_MEETING":
-        recieved_Intent(body["body"]["content"])
+    if result["label"] == "INTENT_SCHEDULE_MEETING":
+        recieved_Intent(result)
 
-    
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main())
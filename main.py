@@ -1,64 +1,144 @@
 import base64
-from email.utils import parsedate_to_datetime
+import os
+import time
+from collections import deque
+from datetime import datetime
+from html.parser import HTMLParser
 import json
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
+# Gmail caps a batch at 100 calls but advises <= 50: messages.get costs 5
+# quota units each, and bigger batches hit per-user rateLimitExceeded (429).
+BATCH_LIMIT = 50
+BATCH_RETRIES = 3  # extra rounds for sub-requests that failed, with backoff
+RETRY_STATUSES = (429, 500, 503)  # transient errors worth retrying
 SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
 CLIENT_FILE = "client.json"
+TOKEN_FILE = "token.json"  # saved credentials, so the browser flow runs only once
+# Headers fetch_message_structured actually uses.
+WANTED_HEADERS = frozenset({"from", "to", "subject", "date"})
+# Partial response mask for messages.get: only what fetch_message_structured
+# reads. Drops sizeEstimate/historyId, and for the payload and the first three
+# levels of nested parts keeps just mimeType, inline body data and child parts
+# (no partId, filename, per-part headers, body.size or attachmentId). Parts
+# nested deeper than that still come back in full.
+MESSAGE_FIELDS = (
+    "id,threadId,labelIds,internalDate,snippet,"
+    "payload(headers(name,value),mimeType,body/data,"
+    "parts(mimeType,body/data,parts(mimeType,body/data,parts(mimeType,body/data,parts))))"
+)
 
 def b64url_decode(data: str) -> str:
     """
     Gmail returns email bodies as base64-url-safe encoded strings.
     This decodes them into normal text.
     """
-    return base64.urlsafe_b64decode(data.encode("utf-8")).decode("utf-8", errors="replace")
+    # b64decode takes the (ASCII) str directly; no need to encode it first.
+    return base64.urlsafe_b64decode(data).decode("utf-8", errors="replace")
 
-def headers_to_dict(headers):
+def headers_to_dict(headers, wanted=WANTED_HEADERS):
     """
     Gmail returns headers as a list of {name, value} pairs.
     This turns it into a normal dict like {"from": "...", "subject": "..."}.
+    Only the `wanted` (lowercase) names are kept, and the scan stops once
+    all of them are found, skipping the Received/DKIM/ARC/List-* noise.
     """
-    return {h["name"].lower(): h["value"] for h in (headers or [])}
+    out = {}
+    for h in headers or []:
+        name = h["name"].lower()
+        if name in wanted and name not in out:
+            out[name] = h["value"]
+            if len(out) == len(wanted):
+                break
+    return out
 
-def extract_body_text(payload) -> dict:
+class _TextExtractor(HTMLParser):
+    """
+    Collects the visible text of an HTML document, dropping tags and the
+    contents of <script>/<style>/<title>.
+    """
+    # Not "head": HTML lets </head> be omitted, which would leave skip_depth
+    # stuck above 0 and drop the whole body. Its text-bearing children are
+    # skipped individually; meta/link carry no text.
+    SKIP = {"script", "style", "title"}
+    BLOCK = {"p", "div", "br", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "table"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skip_depth += 1
+        elif tag in self.BLOCK:
+            self.chunks.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self.skip_depth:
+            self.skip_depth -= 1
+        elif tag in self.BLOCK:
+            self.chunks.append("\n")
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.chunks.append(data)
+
+def html_to_text(html: str) -> str:
+    """
+    Strips markup (CSS, scripts, tracking pixels) so only readable text is
+    handed to the model. Line breaks only come from block tags, so inline
+    markup like "Meet <b>next</b> week" stays on one line.
+    """
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    text = "".join(parser.chunks)
+
+    # Collapse the whitespace left behind by the markup
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+def extract_body_text(payload, keep_html=False) -> dict:
     """
     Gmail message bodies can be multipart (nested parts).
     We walk the structure and select the best body:
       1) first text/plain found
-      2) else first text/html found
+      2) else first text/html found, converted to plain text
+         (raw HTML is kept only when keep_html=True, for debugging)
     Returns {"mimeType": "...", "content": "..."}.
     """
-    best_plain = None
     best_html = None
 
-    def walk(part):
-        nonlocal best_plain, best_html
+    # Iterative depth-first walk (same order as a recursive walk): children
+    # are pushed on the left so the first child is visited next.
+    queue = deque([payload or {}])
+    while queue:
+        part = queue.popleft()
 
         mime = part.get("mimeType", "")
         body = part.get("body", {}) or {}
         data = body.get("data")  # base64url text for this part, if present
 
-        if data:
-            text = b64url_decode(data)
-            if mime == "text/plain" and best_plain is None:
-                best_plain = text
-            elif mime == "text/html" and best_html is None:
-                best_html = text
-
-        # If this part is multipart, recurse into children
-        for child in part.get("parts", []) or []:
-            walk(child)
+        # First text/plain wins, so there is nothing left to look for.
+        if data and mime == "text/plain":
+            return {"mimeType": "text/plain", "content": b64url_decode(data)}
+        if data and mime == "text/html" and best_html is None:
+            best_html = b64url_decode(data)
 
-    walk(payload or {})
+        # If this part is multipart, walk its children next
+        queue.extendleft(reversed(part.get("parts", []) or []))
 
-    if best_plain is not None:
-        return {"mimeType": "text/plain", "content": best_plain}
     if best_html is not None:
-        return {"mimeType": "text/html", "content": best_html}
+        if keep_html:
+            return {"mimeType": "text/html", "content": best_html}
+        return {"mimeType": "text/plain", "content": html_to_text(best_html)}
     return {"mimeType": None, "content": ""}
 
 def build_gmail_service():
@@ -68,13 +148,34 @@ def build_gmail_service():
     - This function runs the interactive browser flow and returns a Gmail client.
 
     What happens:
-    - Reads CLIENT_FILE (client_id, redirect URI, etc.)
-    - Opens browser for you to log in and approve SCOPES
-    - Returns credentials (access token) in memory
+    - Loads saved credentials from TOKEN_FILE if present, refreshing the
+      access token when it has expired (a revoked/expired refresh token, e.g.
+      after 7 days for apps in "Testing" status, falls back to the browser flow)
+    - Otherwise reads CLIENT_FILE (client_id, redirect URI, etc.) and
+      opens browser for you to log in and approve SCOPES
+    - Saves the credentials to TOKEN_FILE (owner-only, 0o600) for the next run
     - Builds a Gmail API client object you can call .users().messages() on
     """
-    flow = InstalledAppFlow.from_client_secrets_file(CLIENT_FILE, SCOPES)
-    creds = flow.run_local_server(port=0)  # port=0 picks a free local port
+    creds = None
+    if os.path.exists(TOKEN_FILE):
+        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+            except RefreshError:
+                creds = None
+        if not creds or not creds.valid:
+            flow = InstalledAppFlow.from_client_secrets_file(CLIENT_FILE, SCOPES)
+            creds = flow.run_local_server(port=0)  # port=0 picks a free local port
+
+        # The file holds a refresh token, so keep it readable by the owner only
+        fd = os.open(TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.chmod(TOKEN_FILE, 0o600)  # in case it already existed with wider perms
+        with os.fdopen(fd, "w") as f:
+            f.write(creds.to_json())
+
     return build("gmail", "v1", credentials=creds)
 
 def get_most_recent_message_id(service, inbox_only=True) -> str | None:
@@ -86,18 +187,30 @@ def get_most_recent_message_id(service, inbox_only=True) -> str | None:
 
     Returns the message id string, or None if no messages.
     """
-    params = {"userId": "me", "maxResults": 1}
+    ids = get_recent_message_ids(service, 1, inbox_only=inbox_only)
+    return ids[0] if ids else None
+
+def get_recent_message_ids(service, count: int, inbox_only=True) -> list[str]:
+    """
+    Gmail API pattern:
+    - users.messages.list gives you message IDs (not bodies)
+    - maxResults=count means "only the newest `count`"
+    - labelIds=["INBOX"] restricts to Inbox (optional)
+
+    Returns up to `count` message id strings, newest first.
+    """
+    params = {"userId": "me", "maxResults": count}
     if inbox_only:
         params["labelIds"] = ["INBOX"]
 
     resp = service.users().messages().list(**params).execute()
-    msgs = resp.get("messages", [])
-    return msgs[0]["id"] if msgs else None
+    return [m["id"] for m in resp.get("messages", [])]
 
 def fetch_message_structured(service, message_id: str) -> dict:
     """
     To get body text, we must fetch the full message:
     - users.messages.get(format="full") returns headers + MIME payload parts.
+    - fields=MESSAGE_FIELDS trims the response to what we actually read.
     - We parse headers and decode the best text body from parts.
 
     Returns a clean dict suitable for logging / downstream processing.
@@ -105,19 +218,75 @@ def fetch_message_structured(service, message_id: str) -> dict:
     msg = (
         service.users()
         .messages()
-        .get(userId="me", id=message_id, format="full")
+        .get(userId="me", id=message_id, format="full", fields=MESSAGE_FIELDS)
         .execute()
     )
+    return structure_message(msg)
+
+def fetch_messages_structured(service, message_ids: list[str]) -> list[dict]:
+    """
+    Batched fetch_message_structured: packs up to BATCH_LIMIT messages.get
+    calls into one HTTP request instead of one round-trip per message.
+    Sub-requests that fail transiently (RETRY_STATUSES, e.g. 429
+    rateLimitExceeded) don't discard the rest of the batch; they are retried
+    up to BATCH_RETRIES times with exponential backoff, and only then is the
+    first error raised. Any other error (404 deleted id, 400, 403) is raised
+    as soon as its batch finishes.
+
+    Returns structured dicts in the same order as message_ids.
+    """
+    raw = {}
+    failed = {}
+
+    def collect(request_id, response, exception):
+        if exception is not None:
+            failed[request_id] = exception
+        else:
+            raw[request_id] = response
 
+    todo = list(message_ids)
+    for attempt in range(BATCH_RETRIES + 1):
+        if attempt:
+            time.sleep(2 ** (attempt - 1))
+        failed.clear()
+        for start in range(0, len(todo), BATCH_LIMIT):
+            batch = service.new_batch_http_request(callback=collect)
+            for mid in todo[start:start + BATCH_LIMIT]:
+                batch.add(
+                    service.users()
+                    .messages()
+                    .get(userId="me", id=mid, format="full", fields=MESSAGE_FIELDS),
+                    request_id=mid,
+                )
+            batch.execute()
+            for exception in failed.values():
+                if not (isinstance(exception, HttpError) and exception.resp.status in RETRY_STATUSES):
+                    raise exception
+        if not failed:
+            break
+        todo = [mid for mid in todo if mid in failed]
+    else:
+        raise next(iter(failed.values()))
+
+    return [structure_message(raw[mid]) for mid in message_ids]
+
+def structure_message(msg: dict) -> dict:
+    """
+    Turns a raw users.messages.get response into the clean dict returned by
+    fetch_message_structured.
+    """
     payload = msg.get("payload", {}) or {}
     hdrs = headers_to_dict(payload.get("headers", []))
 
-    # Email Date header can be inconsistent; we try to normalize to ISO.
+    # Email Date header can be inconsistent; Gmail's internalDate (epoch ms)
+    # is authoritative and far cheaper to turn into ISO than an RFC 2822 parse.
     raw_date = hdrs.get("date", "")
-    try:
-        date_iso = parsedate_to_datetime(raw_date).isoformat() if raw_date else ""
-    except Exception:
-        date_iso = ""
+    internal_ms = msg.get("internalDate")
+    date_iso = (
+        datetime.fromtimestamp(int(internal_ms) / 1000).astimezone().isoformat()
+        if internal_ms
+        else ""
+    )
 
     body = extract_body_text(payload)
 
@@ -125,7 +294,7 @@ def fetch_message_structured(service, message_id: str) -> dict:
         "id": msg.get("id"),
         "threadId": msg.get("threadId"),
         "labelIds": msg.get("labelIds", []),
-        "internalDate_ms": msg.get("internalDate"),  # Gmail's internal timestamp
+        "internalDate_ms": internal_ms,  # Gmail's internal timestamp
         "headers": {
             "from": hdrs.get("from", ""),
             "to": hdrs.get("to", ""),
@@ -146,6 +315,15 @@ def get_latest_email_body_text() -> dict:
     msg_id = get_most_recent_message_id(service, inbox_only=True)
     return fetch_message_structured(service, msg_id)
 
+def get_latest_emails(count: int) -> list[dict]:
+    """
+    Returns the `count` newest Inbox emails as structured dicts, fetched in
+    batched requests.
+    """
+    service = build_gmail_service()
+    msg_ids = get_recent_message_ids(service, count, inbox_only=True)
+    return fetch_messages_structured(service, msg_ids)
+
 
 if __name__ == "__main__":
     # 1) Authenticate + create Gmail API client